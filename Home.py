@@ -1,15 +1,20 @@
+import time
+_start = time.perf_counter()
+import os
+import sys
+import uuid
+from functools import partial
 import streamlit as st
 from datetime import datetime
-import streamlit as st
-import geopandas as gpd
 import pandas as pd
-import folium
-from streamlit_folium import st_folium
-import matplotlib.cm as cm
-import matplotlib.colors as colors
-import plotly.express as px
-import numpy as np
-from utils import apply_filters, plot_projects, plot_swarm, set_font, plot_contractors
+
+# first run in this process pays for every import; later reruns reuse sys.modules
+cold_start = "utils" not in sys.modules
+from utils import apply_filters, set_font, CompactCircles, payload_bytes, read_projects, cost_colors
+from utils import PARTITIONS_DIR, MANIFEST, dataset_catalog, read_manifest, changed_sources, select_partitions, read_partitions
+from utils import build_summary, plot_swarm, swarm_category, summary_key, swarm_key, prefetch_summary, prefetch_swarm, data_version
+from prefetch import Prefetcher
+timings = {"Imports": time.perf_counter() - _start}
 
 st.markdown(set_font(), unsafe_allow_html=True)
 
@@ -37,15 +42,38 @@ st.set_page_config(layout="wide")
 st.markdown("## Large investment in flood control projects started in 2022.")
 st.write("This tracker is interactive, select from the filters on the left side panel to explore the data.")
 
-df = gpd.read_file('flood_control_projects.geojson')
-df["StartDate"] = pd.to_datetime(df["StartDate"], errors="coerce")
-df["StartYear"] = df["StartDate"].dt.year.astype("Int64")
-df["lon"] = df["geometry"].x
-df["lat"] = df["geometry"].y
-df['ContractCost_normalized'] = (df['ContractCost']-df['ContractCost'].min())/(df['ContractCost'].max()-df['ContractCost'].min()) * 10000
+# With partitioned data (see partition_data.py) the sidebar is built from the manifest
+# and only the partitions matching the filters are read further down.
+# Otherwise the whole GeoJSON is loaded up front. If the partitions came from a single
+# export that has changed since, that export is loaded instead; with several exports
+# the partitions are kept (falling back to one file would drop the others) and we warn.
+_step = time.perf_counter()
+geojson_path = 'flood_control_projects.geojson'
+partitioned = os.path.exists(os.path.join(PARTITIONS_DIR, MANIFEST))
+if partitioned:
+    manifest = read_manifest(PARTITIONS_DIR)
+    changed = changed_sources(manifest)
+    if changed and len(manifest["sources"]) == 1:
+        partitioned = False
+        geojson_path = changed[0]
+        st.warning(f"{geojson_path} changed after {PARTITIONS_DIR}/ was written, so it is loaded in full instead. "
+                   "Re-run partition_data.py to refresh the partitions.")
+    elif changed:
+        st.warning(f"{', '.join(changed)} changed after {PARTITIONS_DIR}/ was written, so the data shown may be out of date. "
+                   "Re-run partition_data.py to refresh the partitions.")
+if partitioned:
+    catalog = manifest["catalog"]
+else:
+    df = read_projects(geojson_path)  # points only, so no geopandas needed
+    df["StartDate"] = pd.to_datetime(df["StartDate"], errors="coerce")
+    df["StartYear"] = df["StartDate"].dt.year.astype("Int64")
+    catalog = dataset_catalog(df)
+timings["Load data"] = time.perf_counter() - _step
 
-norm = colors.Normalize(vmin=df["ContractCost"].min(), vmax=df["ContractCost"].max())
-colormap = cm.ScalarMappable(norm=norm, cmap="Reds")  
+locations = pd.DataFrame(catalog["locations"], columns=["Region", "Province", "Municipality"])
+cost_min, cost_max = catalog["ranges"]["ContractCost"]
+start_year_min, start_year_max = catalog["ranges"]["StartYear"]
+completion_year_min, completion_year_max = catalog["ranges"]["CompletionYear"]
 
 
 custom_order = [
@@ -67,12 +95,7 @@ custom_order = [
                 "Region XIII",
                 ]
 
-df["Region"] = pd.Categorical(
-    df["Region"],
-    categories=custom_order,
-    ordered=True
-)
-regions_sorted = df["Region"].cat.categories.tolist()
+regions_sorted = custom_order
 
 
 region_values = st.sidebar.selectbox(
@@ -83,11 +106,11 @@ region_values = st.sidebar.selectbox(
 
     # Second dropdown: Province depends on Region
 if region_values is None:
-    province_options = sorted(df["Province"].unique())
+    province_options = sorted(locations["Province"].unique())
 else:
-    province_options = sorted(df.loc[df["Region"] == region_values, "Province"].unique())
+    province_options = sorted(locations.loc[locations["Region"] == region_values, "Province"].unique())
     municipality_sorted = sorted(
-        df.loc[df["Province"] == region_values, "Municipality"].unique(),
+        locations.loc[locations["Province"] == region_values, "Municipality"].unique(),
         key=lambda x: (x is None, x)   # puts None last
     )
     municipality_options = municipality_sorted
@@ -101,13 +124,13 @@ province_values = st.sidebar.selectbox(
 
 if province_values is None:
     municipality_sorted = sorted(
-        df["Municipality"].unique(),
+        locations["Municipality"].unique(),
         key=lambda x: (x is None, x)   # puts None last
     )
     municipality_options = municipality_sorted
 else:
     municipality_sorted = sorted(
-        df.loc[df["Province"] == province_values, "Municipality"].unique(),
+        locations.loc[locations["Province"] == province_values, "Municipality"].unique(),
         key=lambda x: (x is None, x)   # puts None last
     )
     municipality_options = municipality_sorted
@@ -120,26 +143,26 @@ municipality_values = st.sidebar.selectbox(
 
 TypeofWork_values = st.sidebar.selectbox(
     "Type of Work",
-    df["TypeofWork"].unique(),
+    catalog["values"]["TypeofWork"],
     index=None,
 )
 
 Contractor_values = st.sidebar.selectbox(
     "Contractor",
-    df["Contractor"].unique(),
+    catalog["values"]["Contractor"],
     index=None,
 )
 
 start_year_values = st.sidebar.slider("Start Year", 
-                df['StartYear'].min(), 
-                df['StartYear'].max(),
-                (df['StartYear'].min(), df['StartYear'].max()),
+                start_year_min, 
+                start_year_max,
+                (start_year_min, start_year_max),
                 step=1)
 
 completion_year_values = st.sidebar.slider("Completion Year", 
-                df['CompletionYear'].min(), 
-                df['CompletionYear'].max(),
-                (df['CompletionYear'].min(), df['CompletionYear'].max()),
+                completion_year_min, 
+                completion_year_max,
+                (completion_year_min, completion_year_max),
                 step=1)
 
 
@@ -157,6 +180,28 @@ num_ranges = {
     "CompletionYear": completion_year_values,
 }
 
+@st.cache_resource
+def get_prefetcher():
+    # one per process: 2 workers and 64 MB of results is the budget for all sessions together
+    return Prefetcher(max_workers=2, max_bytes=64_000_000)
+
+prefetcher = get_prefetcher()
+if "prefetch_session" not in st.session_state:
+    st.session_state["prefetch_session"] = uuid.uuid4().hex
+session = st.session_state["prefetch_session"]
+# prefetched results are only reused while the data they were built from is unchanged
+version = data_version(os.path.join(PARTITIONS_DIR, MANIFEST) if partitioned else geojson_path)
+
+options = list(range(1_000_000, 291_000_000, 1_000_000))
+labels = [f"{x//1_000_000}M" for x in options]
+label_to_value = dict(zip(labels, options))
+# the slider is drawn further down, but its value is already known from the session
+threshold = label_to_value[st.session_state.get("threshold", "100M")]
+
+# drop background work for views this selection no longer leads to before
+# reading data and drawing, so it doesn't compete with this run
+prefetcher.cancel(session, keep={summary_key(equals, num_ranges, version), swarm_key(equals, num_ranges, threshold, version)})
+
 
 # Build pills
 pills = []
@@ -213,14 +258,22 @@ st.markdown(
 )
 
 
-norm = colors.LogNorm(
-    vmin=df["ContractCost"].min(),
-    vmax=df["ContractCost"].max()
-)
-
-colormap = cm.ScalarMappable(norm=norm, cmap="Reds")
+_step = time.perf_counter()
+if partitioned:
+    # push the Region filter and year sliders down to the partition manifest
+    partitions = select_partitions(manifest, equals=equals, num_ranges=num_ranges)
+    df = read_partitions(PARTITIONS_DIR, manifest, partitions)
+    timings[f"Read {len(partitions)}/{len(manifest['partitions'])} partitions "
+            f"({sum(p['bytes'] for p in partitions) / 1e6:,.1f} MB)"] = time.perf_counter() - _step
+    _step = time.perf_counter()
 
-df["color"] = df["ContractCost"].apply(lambda v: colors.to_hex(colormap.to_rgba(v)))
+df['ContractCost_normalized'] = (df['ContractCost']-cost_min)/(cost_max-cost_min) * 10000
+df["Region"] = pd.Categorical(
+    df["Region"],
+    categories=custom_order,
+    ordered=True
+)
+df["color"] = cost_colors(df["ContractCost"], vmin=cost_min, vmax=cost_max)
 
 df_filtered = apply_filters(
     df,
@@ -228,6 +281,12 @@ df_filtered = apply_filters(
     num_ranges=num_ranges,
     # date_ranges={"Date": (start_date, end_date)}  # if you have dates
 )
+timings["Filter"] = time.perf_counter() - _step
+
+# the map libraries are imported here, after the header and sidebar are already on screen
+_step = time.perf_counter()
+import folium
+from streamlit_folium import st_folium
 
 map = folium.Map(location=[df_filtered["lat"].mean(), df_filtered["lon"].mean()],
                          zoom_start=5.5,
@@ -235,26 +294,28 @@ map = folium.Map(location=[df_filtered["lat"].mean(), df_filtered["lon"].mean()]
                          )
 feature_group = folium.FeatureGroup("Locations")
 
-for _, row in df_filtered.iterrows():
-    
-    folium.Circle(
-        location=[row["lat"], row["lon"]],
-        # radius=row["radius"],
-        # radius=10000,
-        color=row["color"],
-        fill=True,
-        fill_color=row["color"],
-        fill_opacity=0.7,
-        tooltip=f"""
+# one element for all circles: columns go over as typed arrays / lookup tables
+# and each tooltip is filled in from the template in the browser
+CompactCircles(
+    df_filtered,
+    tooltip="""
         <div style="font-size:13px; line-height:1.4;">
-        <b>Location:</b> {row['Municipality']} <br>
-        <b>Type of Work:</b> {row['TypeofWork']} <br> 
-        <b>Cost:</b> Php {row['ContractCost']:,.0f} <br>
-        <b>Start Year:</b> {row['StartYear']} <br>
-        <b>Completion Year:</b> {row['CompletionYear']} <br>
-        <b>Contractor:</b> {row['Contractor']}
-        """
-    ).add_to(map)
+        <b>Location:</b> {Municipality} <br>
+        <b>Type of Work:</b> {TypeofWork} <br> 
+        <b>Cost:</b> Php {ContractCost:,} <br>
+        <b>Start Year:</b> {StartYear} <br>
+        <b>Completion Year:</b> {CompletionYear} <br>
+        <b>Contractor:</b> {Contractor}
+        """,
+    fields={
+        "Municipality": None,
+        "TypeofWork": None,
+        "ContractCost": "<f8",
+        "StartYear": "<f4",
+        "CompletionYear": "<f4",
+        "Contractor": None,
+    },
+).add_to(map)
 
 # ---- Auto-zoom to filtered data ----
 if not df_filtered.empty:
@@ -269,6 +330,7 @@ if not df_filtered.empty:
         sw = [_coords["lat"].min(), _coords["lon"].min()]  # south-west
         ne = [_coords["lat"].max(), _coords["lon"].max()]  # north-east
         map.fit_bounds([sw, ne], padding=(30, 30))
+timings["Map"] = time.perf_counter() - _step
 
 
 # Optional: add legend
@@ -281,43 +343,24 @@ if not df_filtered.empty:
 # )
 # legend.add_to(map)
 
-counts = df_filtered.groupby("StartYear").size().reset_index(name="metric")
-total_cost = df_filtered.groupby("StartYear", as_index=False).agg(metric=("ContractCost", "sum"))
-avearge_cost = df_filtered.groupby("StartYear", as_index=False).agg(metric=("ContractCost", "mean"))
-
-fig_total_projects = plot_projects(counts)
-fig_total_cost = plot_projects(total_cost, currency=True)
-# fig_average_cost = plot_projects(avearge_cost, currency=True)
+_step = time.perf_counter()
+summary = prefetcher.get(session, summary_key(equals, num_ranges, version))
+fig_projects = prefetcher.get(session, swarm_key(equals, num_ranges, threshold, version))
+prefetched = summary is not None and fig_projects is not None
+if summary is None:
+    summary = build_summary(df_filtered)
+if fig_projects is None:
+    fig_projects = plot_swarm(df_filtered, custom_order, swarm_category(equals), threshold)
+
+fig_total_projects = summary["fig_total_projects"]
+fig_total_cost = summary["fig_total_cost"]
 config = {"displayModeBar": False}
-
-contractors_by_cost = (
-    df_filtered.groupby("Contractor", as_index=False)
-    .agg(metric=("ContractCost", "sum"))
-    .sort_values("metric", ascending=False)
-)
-# add % of total
-total_cost = contractors_by_cost["metric"].sum()
-contractors_by_cost["pct_of_total"] = (
-    contractors_by_cost["metric"] / total_cost * 100
-).round(2)  # 2 decimals
-contractors_by_cost = contractors_by_cost.head(20) #contractors_by_cost[contractors_by_cost['metric']>=1_000_000_000]
-text_pct_cost = f"{int(round(contractors_by_cost["pct_of_total"].sum(), 0))}% of the contracts were awarded to these contractors."
-
-contractors_by_size = (
-    df_filtered.groupby("Contractor")
-    .size()
-    .reset_index(name="metric")
-    .sort_values("metric", ascending=False)
-)
-total_size = contractors_by_size["metric"].sum()
-contractors_by_size["pct_of_total"] = (
-    contractors_by_size["metric"] / total_size * 100
-).round(2)  # 2 decimals
-contractors_by_size = contractors_by_size.head(20) #contractors_by_cost[contractors_by_cost['metric']>=1_000_000_000]
-text_pct_size = f"{int(round(contractors_by_size["pct_of_total"].sum(), 0))}% of the contracts were awarded to these contractors."
-
-fig_contractors_cost = plot_contractors(contractors_by_cost, currency=True)
-fig_contractors_size = plot_contractors(contractors_by_size)
+text_pct_cost = summary["text_pct_cost"]
+text_pct_size = summary["text_pct_size"]
+fig_contractors_cost = summary["fig_contractors_cost"]
+fig_contractors_size = summary["fig_contractors_size"]
+timings["Figures (prefetched)" if prefetched else "Figures"] = time.perf_counter() - _step
+_step = time.perf_counter()
 
 
 st.markdown("""
@@ -371,29 +414,16 @@ with st.container(border=True):
     with col2:
         st.markdown(f"##### {text}")
 
-        options = list(range(1_000_000, 291_000_000, 1_000_000))
-        labels = [f"{x//1_000_000}M" for x in options]
-        label_to_value = dict(zip(labels, options))
-
         selected_label = st.select_slider(
             "Threshold",
             options=labels,
-            value="100M"
+            value="100M",
+            key="threshold"
         )
 
         threshold = label_to_value[selected_label]
         print(threshold)
 
-        if municipality_values != None:
-            fig_projects = plot_swarm(df_filtered, custom_order, "Municipality", threshold)
-        elif province_values != None and municipality_values != None:
-            fig_projects = plot_swarm(df_filtered, custom_order, "Municipality", threshold)
-        elif province_values != None:
-            fig_projects = plot_swarm(df_filtered, custom_order, "Municipality", threshold)
-        elif region_values != None:
-            fig_projects = plot_swarm(df_filtered, custom_order, "Province", threshold)  
-        else:
-            fig_projects = plot_swarm(df_filtered, custom_order, "Region", threshold)
 
         
         st.plotly_chart(fig_projects, use_container_width=True, config=config)
@@ -410,4 +440,44 @@ with st.container(border=True):
         st.write(text_pct_size)
         st.plotly_chart(fig_contractors_size, use_container_width=True, config=config)
 
+timings["Render"] = time.perf_counter() - _step
+
+# Users drill down Region -> Province -> Municipality, so once a Region or Province
+# is picked its children are filtered and plotted in the background, biggest first.
+# The summary doesn't depend on the threshold, so moving the slider only queues swarm charts.
+if municipality_values is None and (region_values is not None or province_values is not None):
+    child_col = "Municipality" if province_values is not None else "Province"
+    jobs = {}
+    for child in df_filtered[child_col].value_counts().index[:12]:
+        child_equals = {**equals, child_col: child}
+        jobs[summary_key(child_equals, num_ranges, version)] = partial(prefetch_summary, df, child_equals, num_ranges)
+        jobs[swarm_key(child_equals, num_ranges, threshold, version)] = partial(
+            prefetch_swarm, df, child_equals, num_ranges, custom_order, threshold
+        )
+    prefetcher.prefetch(session, jobs)
+else:
+    prefetcher.prefetch(session, {})
+
+# ?timing=1 shows where the run went; the first run in a fresh worker is the cold start
+if st.query_params.get("timing"):
+    with st.sidebar.expander("Startup timing", expanded=True):
+        st.write("Cold start" if cold_start else "Warm rerun")
+        for name, seconds in timings.items():
+            st.write(f"{name}: {seconds:.2f} s")
+        st.write(f"Total: {time.perf_counter() - _start:.2f} s")
+
+# ?payload=1 reports how much each component pushes to the browser per rerun
+if st.query_params.get("payload"):
+    with st.sidebar.expander("Payload size", expanded=True):
+        components = {
+            "Map": map,
+            "Projects by year": fig_total_projects,
+            "Cost by year": fig_total_cost,
+            "Swarm": fig_projects,
+            "Contractors by cost": fig_contractors_cost,
+            "Contractors by size": fig_contractors_size,
+        }
+        for name, component in components.items():
+            st.write(f"{name}: {payload_bytes(component) / 1024:,.1f} KB")
+
 st.caption(f"Loaded at {datetime.now():%Y-%m-%d %H:%M:%S}")
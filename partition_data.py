@@ -0,0 +1,20 @@
+"""
+Splits one or more project GeoJSON exports into Region / StartYear parquet
+partitions. When the partitions exist, Home.py reads only the ones that match
+the sidebar filters instead of the whole country.
+
+    python partition_data.py flood_control_projects.geojson [older_export.geojson ...]
+"""
+import sys
+import pandas as pd
+from utils import PARTITIONS_DIR, read_projects, write_partitions
+
+if __name__ == "__main__":
+    paths = sys.argv[1:] or ["flood_control_projects.geojson"]
+    df = pd.concat([read_projects(path) for path in paths], ignore_index=True)
+    df["StartDate"] = pd.to_datetime(df["StartDate"], errors="coerce")
+    df["StartYear"] = df["StartDate"].dt.year.astype("Int64")
+
+    manifest = write_partitions(df, PARTITIONS_DIR, sources=paths)
+    total = sum(p["bytes"] for p in manifest["partitions"])
+    print(f"Wrote {len(df):,} rows to {len(manifest['partitions'])} partitions ({total / 1e6:,.1f} MB) in {PARTITIONS_DIR}/")
@@ -0,0 +1,87 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    """
+    Computes likely next views in the background and keeps the results for get().
+
+    One instance serves the whole process: max_workers is the CPU budget and
+    max_bytes the memory budget across all sessions. Results and jobs are keyed
+    by (session, key), and finished results are evicted least recently used first.
+    Jobs a session no longer wants are cancelled if still queued; running ones
+    throw their result away when they finish.
+    """
+
+    def __init__(self, max_workers=2, max_bytes=64_000_000):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._results = OrderedDict()  # (session, key) -> (value, nbytes)
+        self._futures = {}  # (session, key) -> Future, for jobs still wanted
+        self._bytes = 0
+
+    def get(self, session, key):
+        """
+        Warm result for key, or None. A job that is already running is waited for,
+        since it started before the caller would; a queued one is cancelled instead.
+        """
+        key = (session, key)
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                return self._results[key][0]
+            future = self._futures.get(key)
+            if future is None or future.cancel():
+                self._futures.pop(key, None)
+                return None
+        try:
+            return future.result()
+        except Exception:
+            return None  # the caller computes it itself and sees the error there
+
+    def cancel(self, session, keep=()):
+        """Cancel the session's pending jobs except those in `keep`."""
+        with self._lock:
+            self._cancel(session, keep)
+
+    def prefetch(self, session, jobs):
+        """Start `jobs` ({key: fn}, fn() -> (value, nbytes)) and cancel the session's other pending jobs."""
+        with self._lock:
+            self._cancel(session, jobs)
+            for key, fn in jobs.items():
+                key = (session, key)
+                if key not in self._results and key not in self._futures:
+                    self._futures[key] = self.executor.submit(self._run, key, fn)
+
+    def _cancel(self, session, keep):
+        for key in [k for k in self._futures if k[0] == session and k[1] not in keep]:
+            self._futures.pop(key).cancel()
+
+    def _run(self, key, fn):
+        with self._lock:
+            if key not in self._futures:
+                return None
+        try:
+            value, nbytes = fn()
+        except BaseException:
+            with self._lock:
+                self._futures.pop(key, None)
+            raise
+        # one lock for both, so get() always finds either the future or the result
+        with self._lock:
+            if self._futures.pop(key, None) is not None:
+                self._store(key, value, nbytes)
+        return value
+
+    def _store(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        if key in self._results:
+            self._bytes -= self._results.pop(key)[1]
+        self._results[key] = (value, nbytes)
+        self._bytes += nbytes
+        while self._bytes > self.max_bytes:
+            _, (_, evicted) = self._results.popitem(last=False)
+            self._bytes -= evicted
@@ -1,7 +1,13 @@
-import geopandas as gpd
-import folium
-import plotly.express as px
-import plotly.io as pio
+import base64
+import json
+import os
+import tempfile
+from urllib.parse import quote
+from branca.element import MacroElement
+from jinja2 import Template
+
+# geopandas, folium and plotly are imported inside the functions that use them,
+# so importing utils stays cheap on a cold start
 
 # pio.templates["montserrat"] = pio.templates["plotly_white"]
 
@@ -77,6 +83,8 @@ def set_text(text, size="h3"):
     return outstring
 
 def read_data(filepath):
+    import geopandas as gpd
+
     data = gpd.read_file(filepath)
     data['lon'] = data['geometry'].get_coordinates(ignore_index=True).x
     data['lat'] = data['geometry'].get_coordinates(ignore_index=True).y
@@ -85,6 +93,8 @@ def read_data(filepath):
     return hospitals
 
 def show_map_marker(df):
+    import folium
+
     map = folium.Map(location=[13, 122], 
                  zoom_start=5,
                 #  width=500,
@@ -104,6 +114,8 @@ def show_map_marker(df):
     return map
 
 def show_map_circle(df):
+    import folium
+
     map = folium.Map(location=[13, 122], 
                  zoom_start=5,
                 #  width=500,
@@ -125,6 +137,201 @@ def show_map_circle(df):
 import pandas as pd
 import numpy as np
 
+def file_signature(filepath):
+    """Size and mtime of a file, enough to tell a replaced export from the one a cache was built from."""
+    stat = os.stat(filepath)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def read_projects(filepath):
+    """
+    Reads a point GeoJSON into a plain DataFrame with lon/lat columns, without geopandas.
+    The parsed columns are cached next to the file as parquet (<name>.cache.parquet)
+    and reused while the GeoJSON's size and mtime match the ones recorded in the cache,
+    so a new worker skips the JSON parse too.
+    """
+    cache = os.path.splitext(filepath)[0] + ".cache.parquet"
+    source = file_signature(filepath)
+    if os.path.exists(cache):
+        try:
+            df = pd.read_parquet(cache)
+        except (OSError, ValueError):
+            df = None  # unreadable cache (e.g. a half-written file): re-parse and rewrite it
+        if df is not None and df.attrs.get("source") == source:
+            df.attrs = {}
+            return df
+
+    with open(filepath, encoding="utf-8") as f:
+        features = json.load(f)["features"]
+
+    df = pd.DataFrame.from_records([feature["properties"] for feature in features])
+    coords = [(feature.get("geometry") or {}).get("coordinates") or (np.nan, np.nan) for feature in features]
+    df["lon"] = pd.Series([c[0] for c in coords], index=df.index, dtype="float64")
+    df["lat"] = pd.Series([c[1] for c in coords], index=df.index, dtype="float64")
+
+    tmp = None
+    try:
+        df.attrs = {"source": source}  # pandas keeps attrs in the parquet metadata
+        # write next to the cache and swap it in, so concurrent sessions or a killed
+        # worker never leave a half-written cache behind
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache) or ".", suffix=".tmp")
+        os.close(fd)
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, cache)
+    except (OSError, TypeError, ValueError):
+        # read-only deploys (or columns parquet can't hold) just parse the GeoJSON every cold start
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+    df.attrs = {}
+    return df
+
+def cost_colors(costs, cmap="Reds", vmin=None, vmax=None):
+    """
+    Hex colors for costs on a log scale, computed in one vectorized pass.
+    Pass vmin/vmax when `costs` is only part of the dataset so colors stay comparable.
+    """
+    import matplotlib.colors as colors
+    from matplotlib import colormaps
+
+    norm = colors.LogNorm(
+        vmin=costs.min() if vmin is None else vmin,
+        vmax=costs.max() if vmax is None else vmax,
+    )
+    rgba = colormaps[cmap](norm(costs.to_numpy(dtype="float64")))
+    rgb = np.round(rgba[:, :3] * 255).astype(int)
+    return pd.Series([f"#{r:02x}{g:02x}{b:02x}" for r, g, b in rgb], index=costs.index)
+
+PARTITIONS_DIR = "flood_control_projects"
+MANIFEST = "_manifest.json"
+
+def _json_value(v):
+    if v is None or (not isinstance(v, str) and pd.isna(v)):
+        return None
+    return v.item() if hasattr(v, "item") else v
+
+def dataset_catalog(df):
+    """
+    The few things the sidebar needs from the full dataset: the Region/Province/Municipality
+    combinations, the Type of Work and Contractor options and the year / cost bounds.
+    """
+    locations = df[["Region", "Province", "Municipality"]].drop_duplicates()
+    return {
+        "locations": [[_json_value(v) for v in row] for row in locations.itertuples(index=False)],
+        "values": {col: [_json_value(v) for v in df[col].unique()] for col in ("TypeofWork", "Contractor")},
+        "ranges": {
+            col: [_json_value(df[col].min()), _json_value(df[col].max())]
+            for col in ("StartYear", "CompletionYear", "ContractCost")
+        },
+    }
+
+def write_partitions(df, root, partition_cols=("Region", "StartYear"), sources=()):
+    """
+    Writes df as hive-style parquet partitions, e.g. root/Region=Region%20VII/StartYear=2023/part-0.parquet,
+    plus a manifest with each partition's row count, size and per-column min/max
+    so readers can skip partitions without opening them.
+    `sources` are the exports df was built from; their signatures go in the manifest
+    so manifest_is_current() can tell when an export has been replaced.
+    """
+    partition_cols = list(partition_cols)
+    partitions = []
+    for keys, part in df.groupby(partition_cols, dropna=False, observed=True, sort=True):
+        keys = [_json_value(k) for k in keys]
+        rel_dir = os.path.join(*(
+            f"{col}={'__HIVE_DEFAULT_PARTITION__' if key is None else quote(str(key), safe='')}"
+            for col, key in zip(partition_cols, keys)
+        ))
+        os.makedirs(os.path.join(root, rel_dir), exist_ok=True)
+        path = os.path.join(rel_dir, "part-0.parquet")
+        part.drop(columns=partition_cols).to_parquet(os.path.join(root, path), index=False)
+
+        numeric = part.drop(columns=partition_cols).select_dtypes("number")
+        partitions.append({
+            "path": path,
+            "values": dict(zip(partition_cols, keys)),
+            "rows": len(part),
+            "bytes": os.path.getsize(os.path.join(root, path)),
+            "min": {col: _json_value(v) for col, v in numeric.min().items()},
+            "max": {col: _json_value(v) for col, v in numeric.max().items()},
+        })
+
+    manifest = {
+        "columns": df.columns.tolist(),
+        "dtypes": {col: str(dtype) for col, dtype in df.dtypes.items()},
+        "sources": {path: file_signature(path) for path in sources},
+        "catalog": dataset_catalog(df),
+        "partitions": partitions,
+    }
+    with open(os.path.join(root, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    return manifest
+
+def read_manifest(root):
+    with open(os.path.join(root, MANIFEST), encoding="utf-8") as f:
+        return json.load(f)
+
+def changed_sources(manifest):
+    """
+    Exports the partitions were built from that have changed since. A source that is
+    gone doesn't count: archiving an export (or deploying only the partitions) is fine.
+    """
+    return [
+        path for path, signature in manifest.get("sources", {}).items()
+        if os.path.exists(path) and file_signature(path) != signature
+    ]
+
+def select_partitions(manifest, *, equals=None, num_ranges=None):
+    """
+    Partitions that can hold rows passing apply_filters(equals=..., num_ranges=...).
+    Partition columns are matched on their value, other numeric columns on the
+    partition's min/max. Filters on columns without statistics are left to apply_filters.
+    """
+    selected = []
+    for partition in manifest["partitions"]:
+        values, lo_stats, hi_stats = partition["values"], partition["min"], partition["max"]
+        keep = True
+
+        for col, val in (equals or {}).items():
+            if col not in values or val is None or (isinstance(val, (list, tuple, set)) and len(val) == 0):
+                continue
+            wanted = val if isinstance(val, (list, tuple, set, np.ndarray)) else [val]
+            keep &= values[col] in wanted
+
+        for col, (min_v, max_v) in (num_ranges or {}).items():
+            if min_v is None and max_v is None:
+                continue
+            if col in values:
+                lo = hi = values[col]
+            elif col in lo_stats:
+                lo, hi = lo_stats[col], hi_stats[col]
+            else:
+                continue
+            if lo is None:  # all missing, and missing never passes a range
+                keep = False
+                continue
+            if min_v is not None:
+                keep &= hi >= min_v
+            if max_v is not None:
+                keep &= lo <= max_v
+
+        if keep:
+            selected.append(partition)
+    return selected
+
+def read_partitions(root, manifest, partitions):
+    """Reads only the given partitions and restores their partition columns."""
+    frames = []
+    for partition in partitions:
+        part = pd.read_parquet(os.path.join(root, partition["path"]))
+        for col, val in partition["values"].items():
+            part[col] = val
+        frames.append(part)
+
+    if not frames:
+        return pd.DataFrame(columns=manifest["columns"]).astype(manifest["dtypes"])
+    df = pd.concat(frames, ignore_index=True)
+    # the other columns already come back typed from parquet
+    partition_dtypes = {col: manifest["dtypes"][col] for col in partitions[0]["values"]}
+    return df.astype(partition_dtypes)[manifest["columns"]]
+
 def apply_filters(
     df: pd.DataFrame,
     *,
@@ -182,6 +389,8 @@ def apply_filters(
     return df.loc[mask].copy()
 
 def plot_projects(df, currency=False):
+    import plotly.express as px
+
     fig = px.bar(df, x="StartYear", y="metric", text="metric", color_discrete_sequence=["#7B2D26"] )
     fig.update_xaxes(
         tickmode="linear",   # linear tick spacing
@@ -220,6 +429,7 @@ def hex_to_rgba(hex_color: str, alpha: float = 0.3) -> str:
     return f"rgba({r}, {g}, {b}, {alpha})"
 
 def plot_swarm(df, custom_order, category, threshold):
+    import plotly.express as px
 
     df["color"] = np.where(
     df["ContractCost"] < threshold,
@@ -235,26 +445,38 @@ def plot_swarm(df, custom_order, category, threshold):
    
     categories = df[category].unique().tolist()
 
+    # keep customdata numeric so plotly ships it as a binary typed array;
+    # the location is already the y value and the text columns go in hovertext/text
+    df_plot = df.assign(
+        StartYear=df["StartYear"].astype("float64"),
+        CompletionYear=df["CompletionYear"].astype("float64"),
+    )
+
     fig = px.strip(
-        df,
+        df_plot,
         x="ContractCost",
         y=category,
         category_orders=sort,
         color="color",  # column of hex codes
         color_discrete_map={c: c for c in df["color"].unique()},
-        custom_data=[category, "TypeofWork", "ContractCost", "StartYear", "CompletionYear", "Contractor"]
+        hover_name="TypeofWork",
+        custom_data=["ContractCost", "StartYear", "CompletionYear"]
     )
 
+    # px.strip splits traces by color, keeping row order within each group
+    contractors = df.groupby("color", sort=False)["Contractor"]
+    fig.for_each_trace(lambda trace: trace.update(text=contractors.get_group(trace.name).to_numpy()))
+
     fig.update_traces(
         jitter=0.4, 
         marker=dict(size=8, opacity=0.7),
         hovertemplate=(
-            "<b>Location:</b> %{customdata[0]}<br>"
-            "<b>Type of Work:</b> %{customdata[1]}<br>"
-            "<b>Cost:</b> Php %{customdata[2]:,}<br>"
-            "<b>Start Year:</b> %{customdata[3]}<br>"
-            "<b>Completion Year:</b> %{customdata[4]}<br>"
-            "<b>Contractor:</b> %{customdata[5]}"
+            "<b>Location:</b> %{y}<br>"
+            "<b>Type of Work:</b> %{hovertext}<br>"
+            "<b>Cost:</b> Php %{customdata[0]:,}<br>"
+            "<b>Start Year:</b> %{customdata[1]}<br>"
+            "<b>Completion Year:</b> %{customdata[2]}<br>"
+            "<b>Contractor:</b> %{text}"
             "<extra></extra>"
         )
     )
@@ -296,16 +518,17 @@ def plot_swarm(df, custom_order, category, threshold):
     return fig
 
 def plot_contractors(df, currency=False):
+    import plotly.express as px
 
     if currency==True:
         df_sorted = df.sort_values("metric", ascending=True).copy()
         df_sorted["metric_millions"] = df_sorted["metric"] / 1_000_000
-        custom_data=df_sorted["metric_millions"]
+        custom_data=df_sorted["metric_millions"].to_numpy(dtype="float64")
         template = "%{customdata:,.1f}M"
     else: 
         df_sorted = df.sort_values("metric", ascending=True).copy()
         # df_sorted["metric_billions"] = df_sorted["metric"] / 1_000_000_000
-        custom_data=df['metric'].tolist()[::-1]
+        custom_data=df_sorted["metric"].to_numpy(dtype="float64")  # numpy -> binary typed array, not a JSON list
         template = "%{customdata:,.0f}"
 
     fig = px.bar(
@@ -313,7 +536,6 @@ def plot_contractors(df, currency=False):
         x="metric",
         y="Contractor",
         orientation="h",
-        text="metric",  # placeholder, will override
         category_orders={"Contractor": df_sorted["Contractor"].tolist()[::-1]},
         color_discrete_sequence=["#7B2D26"],
     )
@@ -334,4 +556,182 @@ def plot_contractors(df, currency=False):
                     hoverlabel=dict(font=dict(family="Montserrat, sans-serif", size=12)),
                     )
 
-    return fig
\ No newline at end of file
+    return fig
+
+def encode_column(values, dtype="<f8"):
+    """
+    Encode a column as a base64 typed-array spec the browser can decode cheaply.
+    - numeric columns -> {"dtype", "bdata"} packed with the given dtype
+    - text columns -> integer codes into a "lookup" table of unique strings (-1 = missing)
+    """
+    series = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(series) and not isinstance(series.dtype, pd.CategoricalDtype):
+        array = series.astype("float64").to_numpy().astype(dtype)
+        return {"dtype": array.dtype.str.lstrip("<|"), "bdata": base64.b64encode(array.tobytes()).decode("ascii")}
+
+    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+    codes = codes.astype("<i2" if len(uniques) < np.iinfo(np.int16).max else "<i4")
+    return {
+        "dtype": codes.dtype.str.lstrip("<|"),
+        "bdata": base64.b64encode(codes.tobytes()).decode("ascii"),
+        "lookup": [str(u) for u in uniques],
+    }
+
+
+class CompactCircles(MacroElement):
+    """
+    Draws one Leaflet circle per row from column-encoded data instead of one
+    folium.Circle per row. Numbers travel as typed arrays, repeated strings as
+    lookup tables, and the tooltip HTML is filled in from `tooltip` in the browser.
+
+    `tooltip` uses {column} placeholders; {column:,} adds thousands separators.
+    `fields` maps each tooltip column to the dtype its values are packed as (None for text).
+    """
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.featureGroup().addTo({{ this._parent.get_name() }});
+            (function() {
+                function decode(col) {
+                    var raw = atob(col.bdata);
+                    var bytes = new Uint8Array(raw.length);
+                    for (var i = 0; i < raw.length; i++) { bytes[i] = raw.charCodeAt(i); }
+                    var typed = {f4: Float32Array, f8: Float64Array, i2: Int16Array, i4: Int32Array};
+                    var values = new typed[col.dtype](bytes.buffer);
+                    if (!col.lookup) { return values; }
+                    return Array.from(values, function(code) { return code < 0 ? null : col.lookup[code]; });
+                }
+                function format(value, grouping) {
+                    if (value === null || value === undefined || (typeof value === "number" && isNaN(value))) { return ""; }
+                    if (typeof value === "number") {
+                        return value.toLocaleString("en-US", {maximumFractionDigits: 0, useGrouping: grouping});
+                    }
+                    return value;
+                }
+
+                var columns = {{ this.columns|tojson }};
+                var data = {};
+                for (var key in columns) { data[key] = decode(columns[key]); }
+                var template = {{ this.tooltip|tojson }};
+                var options = {{ this.options|tojson }};
+
+                for (var i = 0; i < data.lat.length; i++) {
+                    var color = data.color[i];
+                    var circle = L.circle(
+                        [data.lat[i], data.lon[i]],
+                        Object.assign({}, options, {color: color, fillColor: color})
+                    );
+                    circle.bindTooltip((function(row) {
+                        return function() {
+                            return template.replace(/\\{(\\w+)(:,)?\\}/g, function(_, key, grouping) {
+                                return format(data[key][row], !!grouping);
+                            });
+                        };
+                    })(i), {sticky: true});
+                    circle.addTo({{ this.get_name() }});
+                }
+            })();
+        {% endmacro %}
+        """)
+
+    def __init__(self, df, tooltip, fields, radius=50, fill_opacity=0.7):
+        super().__init__()
+        self._name = "CompactCircles"
+        columns = {
+            "lat": encode_column(df["lat"], "<f4"),
+            "lon": encode_column(df["lon"], "<f4"),
+            "color": encode_column(df["color"].astype(str)),
+        }
+        for col, dtype in fields.items():
+            columns[col] = encode_column(df[col], dtype)
+        self.columns = columns
+        self.tooltip = tooltip
+        self.options = {"radius": radius, "fill": True, "fillOpacity": fill_opacity}
+
+
+def payload_bytes(component):
+    """Number of bytes a plotly figure or folium map sends to the browser on each rerun."""
+    if hasattr(component, "get_root"):  # folium map
+        from streamlit_folium import generate_leaflet_string
+
+        # the script st_folium ships, not the standalone page with its CDN tags
+        return len(generate_leaflet_string(component).encode("utf-8"))
+    return len(component.to_json().encode("utf-8"))
+
+
+def build_summary(df_filtered):
+    """Aggregates, figures and captions for the year and contractor charts of one filter state."""
+    counts = df_filtered.groupby("StartYear").size().reset_index(name="metric")
+    total_cost = df_filtered.groupby("StartYear", as_index=False).agg(metric=("ContractCost", "sum"))
+
+    contractors_by_cost = (
+        df_filtered.groupby("Contractor", as_index=False)
+        .agg(metric=("ContractCost", "sum"))
+        .sort_values("metric", ascending=False)
+    )
+    # add % of total
+    contractors_by_cost["pct_of_total"] = (
+        contractors_by_cost["metric"] / contractors_by_cost["metric"].sum() * 100
+    ).round(2)  # 2 decimals
+    contractors_by_cost = contractors_by_cost.head(20)
+
+    contractors_by_size = (
+        df_filtered.groupby("Contractor")
+        .size()
+        .reset_index(name="metric")
+        .sort_values("metric", ascending=False)
+    )
+    contractors_by_size["pct_of_total"] = (
+        contractors_by_size["metric"] / contractors_by_size["metric"].sum() * 100
+    ).round(2)  # 2 decimals
+    contractors_by_size = contractors_by_size.head(20)
+
+    return {
+        "fig_total_projects": plot_projects(counts),
+        "fig_total_cost": plot_projects(total_cost, currency=True),
+        "fig_contractors_cost": plot_contractors(contractors_by_cost, currency=True),
+        "fig_contractors_size": plot_contractors(contractors_by_size),
+        "text_pct_cost": f"{int(round(contractors_by_cost['pct_of_total'].sum(), 0))}% of the contracts were awarded to these contractors.",
+        "text_pct_size": f"{int(round(contractors_by_size['pct_of_total'].sum(), 0))}% of the contracts were awarded to these contractors.",
+    }
+
+def swarm_category(equals):
+    """The level the swarm chart breaks down by: one below the deepest location filter."""
+    if equals.get("Municipality") is not None or equals.get("Province") is not None:
+        return "Municipality"
+    if equals.get("Region") is not None:
+        return "Province"
+    return "Region"
+
+def data_version(path):
+    """Identifies the data a result was built from, so a replaced export or refreshed partitions miss old results."""
+    signature = file_signature(path)
+    return (path, signature["size"], signature["mtime_ns"])
+
+def filter_key(equals, num_ranges, version):
+    """Hashable key for a filter state on one data version, used to look up prefetched results."""
+    return (
+        version,
+        tuple(sorted(equals.items())),
+        tuple(sorted((col, tuple(bounds)) for col, bounds in num_ranges.items())),
+    )
+
+def summary_key(equals, num_ranges, version):
+    return ("summary", filter_key(equals, num_ranges, version))
+
+def swarm_key(equals, num_ranges, threshold, version):
+    return ("swarm", filter_key(equals, num_ranges, version), threshold)
+
+def prefetch_summary(df, equals, num_ranges):
+    """
+    Background job for Prefetcher: filters df and builds the summary.
+    Returns (summary, nbytes), sized by what the figures send to the browser.
+    """
+    summary = build_summary(apply_filters(df, equals=equals, num_ranges=num_ranges))
+    nbytes = sum(payload_bytes(v) if hasattr(v, "to_json") else len(v) for v in summary.values())
+    return summary, nbytes
+
+def prefetch_swarm(df, equals, num_ranges, custom_order, threshold):
+    """Background job for Prefetcher: filters df and builds the swarm chart. Returns (fig, nbytes)."""
+    df_filtered = apply_filters(df, equals=equals, num_ranges=num_ranges)
+    fig = plot_swarm(df_filtered, custom_order, swarm_category(equals), threshold)
+    return fig, payload_bytes(fig)